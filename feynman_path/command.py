@@ -1,4 +1,6 @@
 import argparse
+from pathlib import Path
+import drawsvg as draw
 import latextools
 
 from . import diagram
@@ -60,33 +62,49 @@ def draw_circuit_pdf(n_qubits, gates):
             const_row=True, const_col=True, const_size=True)
     return pdf
 
+def _write_png(d, name, scale=1, svg_text=None):
+    '''Rasterize in memory and write the PNG with a single call.
+
+    `svg_text` is reused instead of serializing the drawing again when the
+    drawing is already at the requested scale.
+    '''
+    at_scale = (d.pixel_scale, d.render_width, d.render_height) == (
+            scale, None, None)
+    if svg_text is None or not at_scale:
+        d.set_pixel_scale(scale)
+        svg_text = d.as_svg()
+    Path(f'{name}.png').write_bytes(draw.Raster.from_svg(svg_text).png_data)
+
 def save_formats_from_pdf(p, name, msg='', svg=False, png=False, pdf=False,
                           scale=1):
     if pdf:
-        p.save(f'{name}.pdf')
+        Path(f'{name}.pdf').write_bytes(p.data)
         print(f'Saved "{name}.pdf"{msg}')
     if svg or png:
         d = p.as_svg().as_drawing()
+        # The unscaled SVG text is only needed for SVG output
+        svg_text = d.as_svg() if svg else None
     if svg:
-        d.save_svg(f'{name}.svg')
+        Path(f'{name}.svg').write_text(svg_text, encoding='utf-8')
         print(f'Saved "{name}.svg"{msg}')
     if png:
-        d.set_pixel_scale(scale)
-        d.save_png(f'{name}.png')
+        _write_png(d, name, scale=scale, svg_text=svg_text)
         print(f'Saved "{name}.png"{msg}')
 
 def save_formats_from_svg(d, name, msg='', svg=False, png=False, pdf=False,
                           scale=1):
+    # Serialize the drawing once and reuse it for each format.  PNG only
+    # output is serialized at the requested scale by _write_png().
+    svg_text = d.as_svg() if svg or pdf else None
     if pdf:
-        p = latextools.svg_to_pdf(d)
-        p.save(f'{name}.pdf')
+        p = latextools.svg_to_pdf(text=svg_text)
+        Path(f'{name}.pdf').write_bytes(p.data)
         print(f'Saved "{name}.pdf"{msg}')
     if svg:
-        d.save_svg(f'{name}.svg')
+        Path(f'{name}.svg').write_text(svg_text, encoding='utf-8')
         print(f'Saved "{name}.svg"{msg}')
     if png:
-        d.set_pixel_scale(scale)
-        d.save_png(f'{name}.png')
+        _write_png(d, name, scale=scale, svg_text=svg_text)
         print(f'Saved "{name}.png"{msg}')
 
 def main(name, n_qubits, gates, svg=False, png=False, pdf=False, sequence=False,
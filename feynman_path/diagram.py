@@ -1,11 +1,32 @@
 import functools
-import itertools
+import hashlib
+import os
+import subprocess
+import tempfile
+from pathlib import Path
+import numpy as np
 import sympy
 from sympy.printing.latex import latex
 import drawsvg as draw
 import latextools
 
+
+def _default_cache_dir():
+    # Empty or relative XDG_CACHE_HOME values must be ignored per the XDG spec
+    xdg_cache = os.environ.get('XDG_CACHE_HOME', '')
+    if not os.path.isabs(xdg_cache):
+        return Path.home() / '.cache' / 'feynman_path'
+    return Path(xdg_cache) / 'feynman_path'
+
 VERBOSE = False
+# Rendered LaTeX snippets are saved here across runs (None to disable)
+CACHE_DIR = _default_cache_dir()
+# Change to invalidate all previously cached snippets
+_CACHE_VERSION = 1
+# Experimental: compile all labels of a diagram with one pdflatex run as
+# pages of a multi-page document.  Its output has not yet been compared
+# against the default one-document-per-label rendering.
+BATCH_LATEX = False
 
 
 def _disp(svg, msg):
@@ -23,16 +44,160 @@ def _disp(svg, msg):
     display(DispWrap())
     return svg
 
+# Rendered LaTeX snippets shared by every diagram in this process
+_rendered = {}
+# Arrow markers by color shared by every diagram in this process
+_arrow_markers = {}
+
+def _run(args, cwd):
+    try:
+        p = subprocess.run(args, cwd=cwd, capture_output=True)
+    except FileNotFoundError:
+        raise latextools.LatexError(f'{args[0]} command not found.')
+    if p.returncode != 0:
+        raise latextools.LatexError(
+                (p.stdout + p.stderr).decode(errors='replace'))
+
 @functools.lru_cache(maxsize=None)
-def render_cache(latex):
-    return _disp(latextools.render_snippet(
+def _preamble(multi=False):
+    '''Returns the LaTeX source before \\begin{document} for the snippets.
+
+    With `multi`, each snippet is one page of a multi-page standalone
+    document.  Otherwise this is the preamble `_render_single()` uses.
+    '''
+    # Same border as render_snippet(..., pad=1)
+    options = ['border={1pt 1pt 1pt 1pt}']
+    if multi:
+        options.insert(0, 'multi')
+    config = latextools.DocumentConfig('standalone', options=options)
+    content = latextools.BasicContent(
+            '', [latextools.pkg.qcircuit, latextools.pkg.xcolor],
+            [latextools.cmd.all_math])
+    doc = content.as_document('code.tex', config=config)
+    preamble = doc.get_content().split(r'\begin{document}')[0]
+    if multi:
+        # Each my environment becomes its own cropped page
+        preamble += '\\standaloneenv{my}\n\n'
+    return preamble
+
+def _render_pages(latex_list):
+    '''Render each snippet as a page of one PDF and convert them to SVG.
+
+    This runs pdflatex and pdf2svg once each regardless of the number of
+    snippets.
+    '''
+    preamble = _preamble(multi=True)
+    body = '\n'.join([
+        r'\begin{document}',
+        *(fr'\begin{{my}}{latex}\end{{my}}' for latex in latex_list),
+        r'\end{document}',
+        '',
+    ])
+    options = ['-halt-on-error', '-file-line-error',
+               '-interaction', 'nonstopmode']
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp = Path(tmp_dir)
+        (tmp / 'code.tex').write_text(preamble + body)
+        _run(['pdflatex', *options, 'code.tex'], cwd=tmp_dir)
+        _run(['pdf2svg', 'code.pdf', 'code-%d.svg', 'all'], cwd=tmp_dir)
+        pages = sorted(tmp.glob('code-*.svg'),
+                       key=lambda path: int(path.stem.split('-')[-1]))
+        return [latextools.convert.Svg(path.read_text()) for path in pages]
+
+def _cache_path(latex, preamble):
+    # The rendered snippet also depends on the document it was compiled in
+    source = f'{_CACHE_VERSION}\n{preamble}\n{latex}'
+    key = hashlib.sha256(source.encode()).hexdigest()
+    return Path(CACHE_DIR) / f'{key}.svg'
+
+def _load_cached(latex, preamble):
+    '''Returns the rendered snippet from the disk cache or None.'''
+    if CACHE_DIR is None:
+        return None
+    try:
+        content = _cache_path(latex, preamble).read_bytes().decode()
+        if not content.rstrip().endswith('</svg>'):
+            # Truncated file
+            return None
+        return latextools.convert.Svg(content)
+    except (OSError, ValueError, StopIteration):
+        # Missing, unreadable, or not a valid SVG
+        return None
+
+def _save_cached(latex, preamble, svg):
+    '''Atomically write a rendered snippet to the disk cache.'''
+    if CACHE_DIR is None:
+        return
+    path = _cache_path(latex, preamble)
+    tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.tmp')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_bytes(svg.content.encode())
+        os.replace(tmp_path, path)
+    except OSError:
+        # The cache is only an optimization
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+
+def _render_single(latex):
+    '''Render one snippet in its own LaTeX document.'''
+    return latextools.render_snippet(
             latex,
             latextools.pkg.qcircuit,
             latextools.pkg.xcolor,
             commands=[latextools.cmd.all_math],
             pad=1,
-        ).as_svg(),
-        msg=f'Rendered LaTeX element: {latex}')
+        ).as_svg()
+
+def render_batch(latex_list):
+    '''Render many LaTeX snippets, skipping ones rendered before.
+
+    Snippets rendered before in this process or found in `CACHE_DIR` are
+    reused.  The rest are compiled one document each or, if `BATCH_LATEX` is
+    set, as pages of a single multi-page standalone document.  If the batch
+    fails, each snippet is compiled separately instead.
+    '''
+    single = _preamble()
+    preambles = [_preamble(multi=True), single] if BATCH_LATEX else [single]
+    missing = []
+    for latex in dict.fromkeys(latex_list):
+        if latex in _rendered:
+            continue
+        for preamble in preambles:
+            svg = _load_cached(latex, preamble)
+            if svg is not None:
+                _rendered[latex] = svg
+                break
+        else:
+            missing.append(latex)
+    if missing:
+        svgs = None
+        if BATCH_LATEX:
+            try:
+                svgs = _render_pages(missing)
+                if len(svgs) != len(missing):
+                    raise latextools.LatexError(
+                            f'Expected {len(missing)} rendered pages but got '
+                            f'{len(svgs)}')
+                preamble = preambles[0]
+            except latextools.LatexError:
+                # Render one at a time so any error names the snippet
+                svgs = None
+        if svgs is None:
+            svgs = [_render_single(latex) for latex in missing]
+            preamble = single
+        for latex, svg in zip(missing, svgs):
+            # Cache under the document the snippet was actually compiled in
+            _save_cached(latex, preamble, svg)
+            _rendered[latex] = svg
+            if VERBOSE:
+                _disp(svg, msg=f'Rendered LaTeX element: {latex}')
+    return [_rendered[latex] for latex in latex_list]
+
+def render_cache(latex):
+    return render_batch([latex])[0]
 
 def sympy_to_math_mode(sym):
     '''Returns the latex math code (without surrounding $) for the sympy symbol.
@@ -41,6 +206,11 @@ def sympy_to_math_mode(sym):
 
 def render_label(amp_sym, label):
     '''Render preset sympy expressions as nice LaTeX equations.'''
+    return render_cache(label_latex(amp_sym, label))
+
+@functools.lru_cache(maxsize=None)
+def label_latex(amp_sym, label):
+    '''Returns the LaTeX code for a state label with its amplitude.'''
     presets = {
         sympy.sympify(0): '0',
         sympy.sympify(1): '1',
@@ -75,7 +245,29 @@ def render_label(amp_sym, label):
         if give_up:
             # The expression displayed may not be simplified in the desired way.
             amp_latex = sympy_to_math_mode(amp_sym_orig)
-    return render_cache(fr'${amp_latex}\ket{{{label}}}$')
+    return fr'${amp_latex}\ket{{{label}}}$'
+
+
+class LatexBatch:
+    '''Collects LaTeX snippets to draw and renders them all at once.
+
+    Each request reserves a placeholder group in the drawing so z-order is
+    preserved.  The placeholders are filled by `render()`.
+    '''
+    def __init__(self):
+        self.pending = []
+
+    def request(self, g, latex, **kwargs):
+        token = draw.Group()
+        g.append(token)
+        self.pending.append((latex, token, kwargs))
+        return token
+
+    def render(self):
+        pending, self.pending = self.pending, []
+        svgs = render_batch([latex for latex, _, _ in pending])
+        for (latex, token, kwargs), svg in zip(pending, svgs):
+            token.draw(svg, **kwargs)
 
 
 class Diagram:
@@ -95,21 +287,52 @@ class Diagram:
         self.w_label = self.font * ws_label
         self.arrow_off = self.w_label/2 * arrow_space
 
+        self.n_qubits = n_qubits
         self.d = draw.Group()
-        self.arrows = {}
+        self.latex = LatexBatch()
+        self.arrows = _arrow_markers
         self.possible_states = [
-            ''.join(map(str, qs[::-1]))
-            for qs in itertools.product(range(2), repeat=n_qubits)
+            format(i, f'0{n_qubits}b')[::-1]
+            for i in range(1 << n_qubits)
         ]
         self.num_states = len(self.possible_states)
+        self.state_index = {s: i for i, s in enumerate(self.possible_states)}
+        self.state_y = [
+            ((self.num_states-1)/2 - state_idx) * self.h_state
+            for state_idx in range(self.num_states)
+        ]
 
         if init_state is None:
             init_state = {'0'*n_qubits: 1}
-        self.state_sequence = [init_state]
+        # States are stored as integers where bit i is the value of qubit i
+        self.state_sequence_int = [{
+            self.state_key(key): amp
+            for key, amp in init_state.items()
+        }]
+        # The same amplitudes keyed by state label
+        self.state_sequence = [{
+            self.possible_states[key]: amp
+            for key, amp in self.state_sequence_int[0].items()
+        }]
+        # Dense numeric shadow of the latest amplitudes for fast zero tests
+        self.state_ints = np.arange(self.num_states)
+        self.amps = np.zeros(self.num_states, dtype=np.complex128)
+        for key, amp in self.state_sequence_int[-1].items():
+            self.amps[key] = complex(amp)
         self.draw_states()
 
+    def flush(self):
+        '''Render all requested LaTeX labels into `self.d`.
+
+        Labels are drawn as empty placeholder groups until this is called.
+        `draw()` calls it automatically.  Call it before using `self.d`
+        directly.
+        '''
+        self.latex.render()
+
     def draw(self):
-        w = (len(self.state_sequence)-1) * self.w_time + self.w_label - self.font*0.5
+        self.flush()
+        w = (len(self.state_sequence_int)-1) * self.w_time + self.w_label - self.font*0.5
         h = (self.num_states-1) * self.h_state + self.font*2 + self.gate_font*3
         x = -self.w_label/2 + self.font
         y = -(self.num_states-1)/2 * self.h_state - self.font*1.5
@@ -121,24 +344,28 @@ class Diagram:
     def _repr_svg_(self):
         return self.draw()._repr_svg_()
 
+    def state_key(self, key):
+        '''Returns the integer state for a state label like '01' or integer.'''
+        return self.state_index[key] if isinstance(key, str) else key
+
     def state_xy(self, key, time):
-        state_idx = self.possible_states.index(key)
-        x = time * self.w_time
-        y = ((self.num_states-1)/2 - state_idx) * self.h_state
-        return x, y
+        return time * self.w_time, self.state_y[self.state_key(key)]
 
     def transition_text(self, g, start_time, label):
         x = (start_time+0.5) * self.w_time
         y = (self.num_states-1)/2 * self.h_state + self.font/2+self.gate_font*3/2
-        g.draw(render_cache(fr'${label}$'),
+        self.latex.request(g, fr'${label}$',
                x=x, y=y, scale=self.gate_font/12, center=True)
 
-    def state_text(self, g, time, key, amp=1):
-        state_idx = self.possible_states.index(key)
+    def state_text(self, g, time, key, amp=1, dropped=None):
+        key = self.state_key(key)
         x, y = self.state_xy(key, time)
-        g.draw(render_label(sympy.sympify(amp), key),
+        amp_sym = amp if isinstance(amp, sympy.Expr) else sympy.sympify(amp)
+        self.latex.request(g, label_latex(amp_sym, self.possible_states[key]),
                x=x+self.w_label/2-self.font*0.2, y=y, scale=self.font/12, center=True, text_anchor='end')
-        if abs(float(amp)) < 1e-8:
+        if dropped is None:
+            dropped = abs(complex(amp)) < 1e-8
+        if dropped:
             # Draw red X over it
             ys = self.font/2*1.4
             xs = self.w_label/2*0.7
@@ -150,7 +377,8 @@ class Diagram:
         key = color
         if key in self.arrows:
             return self.arrows[key]
-        arrow = draw.Marker(-0.1, -0.5, 1.1, 0.5, scale=4)
+        arrow = draw.Marker(-0.1, -0.5, 1.1, 0.5, scale=4,
+                            id=f'arrow-{color[1:]}')
         arrow.append(draw.Lines(1, -0.5, 1, 0.5, 0, 0, fill=color, close=True))
         self.arrows[key] = arrow
         return arrow
@@ -159,14 +387,20 @@ class Diagram:
         rev_xy = xy_list[::-1]
         rev_xy = [rev_xy[i+1-2*(i%2)] for i in range(len(rev_xy))]
         w = 3 * width
-        g.append(draw.Line(*rev_xy,
-                 stroke=color, stroke_width=w, fill='none',
-                 # Pull the line behind the arrow
-                 stroke_dasharray=f'0 {w*4/2} 1000000',
-                 marker_start=self.make_arrow(color)))
+        arrow = self.make_arrow(color)
+        points = ' L'.join(f'{rev_xy[i]},{rev_xy[i+1]}'
+                           for i in range(0, len(rev_xy), 2))
+        # Write the SVG directly since there can be thousands of arrows
+        g.append(draw.Raw(
+            f'<path d="M{points}" stroke="{color}" stroke-width="{w}" '
+            # Pull the line behind the arrow
+            f'fill="none" stroke-dasharray="0 {w*4/2} 1000000" '
+            f'marker-start="url(#{arrow.id})" />',
+            defs=(arrow,)))
 
     def gate_arrow(self, g, time1, key1, key2, amp=1):
-        w = float(abs(amp))
+        amp = complex(amp)
+        w = abs(amp)
         x1, y1 = self.state_xy(key1, time1)
         x2, y2 = self.state_xy(key2, time1+1)
         x1 += self.arrow_off
@@ -176,85 +410,101 @@ class Diagram:
         yy1 = y1 + (y2-y1)*(xx1-x1)/(x2-x1)
         yy2 = y2 - (y2-y1)*(x2-xx2)/(x2-x1)
         color = '#26f'
-        if abs(float(amp) - abs(float(amp))) >= 1e-8:
+        if abs(amp - w) >= 1e-8:
             color = '#e70'
         self.straight_arrow(g, color, xx1, yy1, xx2, yy2, width=w)
 
     def draw_states(self):
-        t = len(self.state_sequence)-1
-        for key, amp in self.state_sequence[-1].items():
-            self.state_text(self.d, t, key, amp=amp)
+        t = len(self.state_sequence_int)-1
+        for key, amp in self.state_sequence_int[-1].items():
+            self.state_text(self.d, t, key, amp=amp,
+                            dropped=abs(self.amps[key]) < 1e-8)
 
-    def add_states(self, new_state):
-        self.state_sequence.append(new_state)
-        self.draw_states()
-        clean_state = {
-            key: amp
-            for key, amp in new_state.items()
-            if abs(float(amp)) >= 1e-8
-        }
-        self.state_sequence[-1] = clean_state
+    def add_states(self, new_state, new_amps=None):
+        '''Draw the new states and keep only those with nonzero amplitude.
+
+        `new_amps` is the dense numeric array of the new amplitudes.  It is
+        built from `new_state` if not given.
+        '''
+        if new_amps is None:
+            new_state = {self.state_key(key): amp
+                         for key, amp in new_state.items()}
+            new_amps = np.zeros(self.num_states, dtype=np.complex128)
+            for key, amp in new_state.items():
+                new_amps[key] = complex(amp)
+        t = len(self.state_sequence_int)
+        # Compare the squared magnitude to avoid a square root per state
+        is_nonzero = new_amps.real**2 + new_amps.imag**2 >= 1e-16
+        clean_state = {}
+        clean_state_str = {}
+        for key, amp in new_state.items():
+            # Zero amplitude states are drawn crossed out and then dropped
+            self.state_text(self.d, t, key, amp=amp,
+                            dropped=not is_nonzero[key])
+            if is_nonzero[key]:
+                clean_state[key] = amp
+                clean_state_str[self.possible_states[key]] = amp
+        self.state_sequence_int.append(clean_state)
+        self.state_sequence.append(clean_state_str)
+        self.amps = new_amps
 
     def perform_h(self, q_i, *, pre_latex=f'', name='H'):
         new_state = {}
-        t = len(self.state_sequence)-1
-        for key, amp in self.state_sequence[-1].items():
-            is_one = key[q_i] == '1'
-            digits = list(key)
-            digits[q_i] = '0'
-            zero = ''.join(digits)
-            digits[q_i] = '1'
-            one = ''.join(digits)
-            zero_amp = 1/sympy.sqrt(2)
+        t = len(self.state_sequence_int)-1
+        mask = 1 << q_i
+        zero_amp = 1/sympy.sqrt(2)
+        h_amp = 2**-0.5
+        for key, amp in self.state_sequence_int[-1].items():
+            is_one = key & mask
+            zero = key & ~mask
+            one = zero | mask
             one_amp = -zero_amp if is_one else zero_amp
-            self.gate_arrow(self.d, t, key, zero, amp=zero_amp)
-            self.gate_arrow(self.d, t, key, one, amp=one_amp)
+            self.gate_arrow(self.d, t, key, zero, amp=h_amp)
+            self.gate_arrow(self.d, t, key, one,
+                            amp=-h_amp if is_one else h_amp)
             if zero not in new_state: new_state[zero] = 0
             if one not in new_state: new_state[one] = 0
             new_state[zero] += amp*zero_amp
             new_state[one] += amp*one_amp
+        i0 = self.state_ints[self.state_ints & mask == 0]
+        i1 = i0 | mask
+        new_amps = np.empty_like(self.amps)
+        new_amps[i0] = (self.amps[i0] + self.amps[i1]) / np.sqrt(2)
+        new_amps[i1] = (self.amps[i0] - self.amps[i1]) / np.sqrt(2)
         self.transition_text(self.d, t, f'{pre_latex}{name}_{q_i}')
-        self.add_states(new_state)
+        self.add_states(new_state, new_amps)
 
     def perform_cnot(self, qi1, qi2, *, pre_latex=f'', name='CNOT'):
         new_state = {}
-        t = len(self.state_sequence)-1
-        for key, amp in self.state_sequence[-1].items():
-            is_one = key[qi1] == '1'
-            is_targ_one = key[qi2] == '1'
-            digits = list(key)
-            if is_one:
-                digits[qi2] = '01'[not is_targ_one]
-            new_key = ''.join(digits)
+        t = len(self.state_sequence_int)-1
+        for key, amp in self.state_sequence_int[-1].items():
+            new_key = key ^ (((key >> qi1) & 1) << qi2)
             self.gate_arrow(self.d, t, key, new_key, amp=1)
-            if new_key not in new_state: new_state[new_key] = 0
-            new_state[new_key] += amp
+            # Like X and Z, CNOT maps each state to a distinct new state
+            new_state[new_key] = amp
+        ints = self.state_ints
+        new_amps = self.amps[ints ^ (((ints >> qi1) & 1) << qi2)]
         self.transition_text(self.d, t, f'{pre_latex}{name}_{{{qi1}{qi2}}}')
-        self.add_states(new_state)
+        self.add_states(new_state, new_amps)
 
     def perform_z(self, q_i, *, pre_latex=f'', name='Z'):
         new_state = {}
-        t = len(self.state_sequence)-1
-        for key, amp in self.state_sequence[-1].items():
-            is_one = key[q_i] == '1'
-            new_amp = -amp if is_one else amp
-            self.gate_arrow(self.d, t, key, key, amp=new_amp/amp)
-            if key not in new_state: new_state[key] = 0
-            new_state[key] += new_amp
+        t = len(self.state_sequence_int)-1
+        for key, amp in self.state_sequence_int[-1].items():
+            is_one = (key >> q_i) & 1
+            self.gate_arrow(self.d, t, key, key, amp=-1 if is_one else 1)
+            new_state[key] = -amp if is_one else amp
+        new_amps = np.where((self.state_ints >> q_i) & 1, -self.amps, self.amps)
         self.transition_text(self.d, t, f'{pre_latex}{name}_{{{q_i}}}')
-        self.add_states(new_state)
+        self.add_states(new_state, new_amps)
 
     def perform_x(self, q_i, *, pre_latex=f'', name='X'):
         new_state = {}
-        t = len(self.state_sequence)-1
-        for key, amp in self.state_sequence[-1].items():
-            is_one = key[q_i] == '1'
-            digits = list(key)
-            digits[q_i] = '01'[not is_one]
-            new_key = ''.join(digits)
+        t = len(self.state_sequence_int)-1
+        for key, amp in self.state_sequence_int[-1].items():
+            new_key = key ^ (1 << q_i)
             self.gate_arrow(self.d, t, key, new_key, amp=1)
-            if new_key not in new_state:
-                new_state[new_key] = 0
-            new_state[new_key] += amp
+            new_state[new_key] = amp
+        new_amps = self.amps[self.state_ints ^ (1 << q_i)]
         self.transition_text(self.d, t, f'{pre_latex}{name}_{{{q_i}}}')
-        self.add_states(new_state)
+        self.add_states(new_state, new_amps)
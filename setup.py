@@ -39,6 +39,7 @@ setup(
     install_requires = [
         'drawSvg~=2.0',
         'latextools~=0.5',
+        'numpy>=1.17',
         'sympy~=1.7',
     ],
 )